@@ -1,12 +1,38 @@
 import contextvars
 import os
-import uuid
+import subprocess
+import sys
 import html
+import itertools
 from pathlib import Path
-from typing import List, Union, Dict
+from typing import List, Optional, Tuple, Union, Dict
 
 from abc import ABC, abstractmethod
+import graphviz
 from graphviz import Digraph
+from graphviz.backend import CalledProcessError
+
+# Root directory that icon directories are relative to.
+_BASE_DIR = Path(os.path.abspath(os.path.dirname(__file__))).parent
+
+# Resolved icon paths, keyed by (icon directory, icon file name).
+_icon_cache: Dict[Tuple[Optional[str], Optional[str]], Optional[str]] = {}
+
+# Node ids are a per-process random prefix followed by a sequence number,
+# which keeps them unique without generating a UUID for every node.
+_ID_PREFIX = os.urandom(4).hex()
+_id_counter = itertools.count()
+
+
+def _startupinfo():
+    """Return the startupinfo hiding the graphviz console window on Windows."""
+    if sys.platform != "win32":
+        return None
+    startupinfo = subprocess.STARTUPINFO()
+    startupinfo.dwFlags |= subprocess.STARTF_USESHOWWINDOW
+    startupinfo.wShowWindow = subprocess.SW_HIDE
+    return startupinfo
+
 
 # Global contexts for a diagrams and a cluster.
 #
@@ -29,10 +55,7 @@ def setdiagram(diagram: "Diagram"):
 
 
 def getcluster() -> "Cluster":
-    try:
-        return __cluster.get()
-    except LookupError:
-        return None
+    return __cluster.get(None)
 
 
 def setcluster(cluster: "Cluster"):
@@ -40,25 +63,33 @@ def setcluster(cluster: "Cluster"):
 
 
 class Context(ABC):
-    __directions = ("TB", "BT", "LR", "RL")
-    __bgcolors = ("#E5F5FD", "#EBF3E7", "#ECE8F6", "#FDF7E3")
-    __depth = 0
+    __directions = frozenset(("TB", "BT", "LR", "RL"))
+    bgcolors = ("#E5F5FD", "#EBF3E7", "#ECE8F6", "#FDF7E3")
 
-    @property
-    def bgcolors(self):
-        return self.__bgcolors
+    def __init__(self, name, **kwargs):
+        self.name = name
+        self.depth = 0
+        # The Digraph is only built on first access, see the dot property.
+        self._dot = None
+        self._dot_kwargs = kwargs
+        # Position of each node statement in the dot body, keyed by node id.
+        self._body_index = {}
 
     @property
-    def depth(self):
-        return self.__depth
+    def dot(self) -> Digraph:
+        # Most nodes are never used as a cluster, so they never need a Digraph
+        # of their own.
+        if self._dot is None:
+            self._dot = self._make_dot()
+        return self._dot
 
-    @depth.setter
-    def depth(self, value):
-        self.__depth = value
+    @dot.setter
+    def dot(self, dot: Digraph):
+        self._dot = dot
 
-    def __init__(self, name, **kwargs):
-        self.name = name
-        self.dot = Digraph(self.name, **kwargs)
+    def _make_dot(self) -> Digraph:
+        """Build the Digraph of this context."""
+        return Digraph(self.name, **self._dot_kwargs)
 
     @abstractmethod
     def __enter__(self):
@@ -74,11 +105,25 @@ class Context(ABC):
     def node(self, node: "Node") -> None:
         """Create a new node."""
         self.dot.node(node.nodeid, label=node.label, **node._attrs)
+        self._body_index[node.nodeid] = len(self.dot.body) - 1
 
     def remove_node(self, node: "Node") -> None:
-        for node_to_remoeve in self.dot.body:
-            if node.nodeid in node_to_remoeve:
-                self.dot.body.remove(node_to_remoeve)
+        """Remove a node previously added with node()."""
+        idx = self._body_index.pop(node.nodeid, None)
+        if idx is None:
+            return
+        # Blank the statement out rather than deleting it, so the positions
+        # of the following statements stay valid. See _compact_body().
+        self.dot.body[idx] = ""
+
+    def _compact_body(self) -> None:
+        """Drop the statements blanked out by remove_node().
+
+        Called once the context is closed, after which its nodes can no
+        longer be removed.
+        """
+        self.dot.body[:] = [line for line in self.dot.body if line]
+        self._body_index.clear()
 
     @abstractmethod
     def subgraph(self, dot: Digraph):
@@ -86,8 +131,8 @@ class Context(ABC):
 
 
 class Diagram(Context):
-    __curvestyles = ("ortho", "curved")
-    __outformats = ("png", "jpg", "svg", "pdf", "dot")
+    __curvestyles = frozenset(("ortho", "curved"))
+    __outformats = frozenset(("png", "jpg", "svg", "pdf", "dot"))
 
     # fmt: off
     _default_graph_attrs = {
@@ -121,6 +166,10 @@ class Diagram(Context):
 
     # fmt: on
 
+    # With auto_sfdp, above this many nodes the dot engine is swapped for sfdp
+    # which scales much better on large graphs.
+    _sfdp_node_threshold = 300
+
     # TODO: Label position option
     # TODO: Save directory option (filename + directory?)
     def __init__(
@@ -136,6 +185,8 @@ class Diagram(Context):
         graph_attr: dict = {},
         node_attr: dict = {},
         edge_attr: dict = {},
+        fast: bool = False,
+        auto_sfdp: bool = False,
     ):
         """Diagram represents a global diagrams context.
 
@@ -151,6 +202,10 @@ class Diagram(Context):
         :param node_attr: Provide node_attr dot config attributes.
         :param edge_attr: Provide edge_attr dot config attributes.
         :param strict: Rendering should merge multi-edges.
+        :param fast: Limit the layout iterations to speed up rendering of large
+            diagrams, at the cost of some layout quality.
+        :param auto_sfdp: Lay out diagrams with more than 300 nodes with the sfdp
+            engine. sfdp ignores clusters and the direction.
         """
 
         self.name = name
@@ -159,17 +214,22 @@ class Diagram(Context):
         elif not filename:
             filename = "_".join(name.split()).lower()
         self.filename = filename
-        super().__init__(self.name, filename=self.filename, strict=strict)
-        self.edges = {}
+        # The Digraph takes its own copy of the default attributes.
+        super().__init__(
+            self.name,
+            filename=self.filename,
+            strict=strict,
+            graph_attr=self._default_graph_attrs,
+            node_attr=self._default_node_attrs,
+            edge_attr=self._default_edge_attrs,
+        )
+        # Pending (tail node, head node, edge attributes), emitted on exit.
+        self.edges = []
+        self._node_count = 0
+        self.auto_sfdp = auto_sfdp
         # Set attributes.
         self.dot.attr(compound="true")
-        for k, v in self._default_graph_attrs.items():
-            self.dot.graph_attr[k] = v
         self.dot.graph_attr["label"] = self.name
-        for k, v in self._default_node_attrs.items():
-            self.dot.node_attr[k] = v
-        for k, v in self._default_edge_attrs.items():
-            self.dot.edge_attr[k] = v
 
         if not self._validate_direction(direction):
             raise ValueError(f'"{direction}" is not a valid direction')
@@ -188,6 +248,12 @@ class Diagram(Context):
                 raise ValueError(f'"{outformat}" is not a valid output format')
         self.outformat = outformat
 
+        if fast:
+            # Cap the network simplex and crossing minimization iterations.
+            self.dot.graph_attr["nslimit"] = "2"
+            self.dot.graph_attr["nslimit1"] = "2"
+            self.dot.graph_attr["mclimit"] = "0.5"
+
         # Merge passed in attributes
         self.dot.graph_attr.update(graph_attr)
         self.dot.node_attr.update(node_attr)
@@ -195,6 +261,8 @@ class Diagram(Context):
 
         self.show = show
         self.autolabel = autolabel
+        # Last (source, image) rendered for notebook display.
+        self._png_cache = (None, None)
 
     def __str__(self) -> str:
         return str(self.dot)
@@ -207,16 +275,38 @@ class Diagram(Context):
         super().__exit__(*args)
         setdiagram(None)
 
-        for (node1, node2), edge in self.edges.items():
-            cluster_node1 = next(node1.nodes_iter, None)
+        # Format every edge statement up front and append them in one go,
+        # rather than going through Digraph.edge() once per edge.
+        edge_line = self.dot._edge
+        if isinstance(edge_line, str):
+            # graphviz < 0.20 keeps the edge statement as a format string.
+            def edge_line(tail, head, attr, fmt=edge_line):
+                return fmt % (tail, head, attr)
+        quote = self.dot._quote_edge
+        attr_list = self.dot._attr_list
+        lines = []
+        for node1, node2, attrs in self.edges:
+            cluster_node1 = node1._first_node
             if cluster_node1:
-                edge._attrs['ltail'] = node1.nodeid
+                attrs['ltail'] = node1.nodeid
                 node1 = cluster_node1
-            cluster_node2 = next(node2.nodes_iter, None)
+            cluster_node2 = node2._first_node
             if cluster_node2:
-                edge._attrs['lhead'] = node2.nodeid
+                attrs['lhead'] = node2.nodeid
                 node2 = cluster_node2
-            self.dot.edge(node1.nodeid, node2.nodeid, **edge.attrs)
+            lines.append(
+                edge_line(
+                    tail=quote(node1.nodeid),
+                    head=quote(node2.nodeid),
+                    attr=attr_list(attrs.pop("label", None), kwargs=attrs),
+                )
+            )
+        self._compact_body()
+        self.dot.body.extend(lines)
+
+        if self.auto_sfdp and self._node_count > self._sfdp_node_threshold and self.dot.engine == "dot":
+            self.dot.engine = "sfdp"
+            self.dot.graph_attr.setdefault("overlap", "prism")
 
         self.render()
         # Remove the graphviz file leaving only the image.
@@ -224,7 +314,12 @@ class Diagram(Context):
         setdiagram(None)
 
     def _repr_png_(self):
-        return self.dot.pipe(format="png")
+        # Notebooks may display the same diagram repeatedly, only run
+        # graphviz again when the source has changed.
+        source = self.dot.source
+        if self._png_cache[0] != source:
+            self._png_cache = (source, self.dot.pipe(format="png"))
+        return self._png_cache[1]
 
     def _validate_curvestyle(self, curvestyle: str) -> bool:
         return curvestyle.lower() in self.__curvestyles
@@ -234,18 +329,55 @@ class Diagram(Context):
 
     def connect(self, node: "Node", node2: "Node", edge: "Edge") -> None:
         """Connect the two Nodes."""
-        self.dot.edge(node.nodeid, node2.nodeid, **edge.attrs)
+        # Edges are only written out on exit, once every cluster is known.
+        # Their attributes are captured now as the Edge may be reused.
+        self.edges.append((node, node2, edge.attrs))
 
     def subgraph(self, dot: Digraph):
         """Create a subgraph for clustering"""
         self.dot.subgraph(dot)
 
+    def write_source(self, fp) -> None:
+        """Write the DOT source line by line to a file object.
+
+        This is the source before layout, unlike the "dot" output format which
+        is the -Tdot output laid out by graphviz. It is a standalone export
+        helper and is not used by render().
+
+        :param fp: Writable text file object.
+        """
+        for line in self.dot:
+            fp.write(line)
+            # graphviz < 0.20 yields the lines without their newline.
+            if not line.endswith("\n"):
+                fp.write("\n")
+
     def render(self) -> None:
-        if isinstance(self.outformat, list):
-            for one_format in self.outformat:
-                self.dot.render(format=one_format, view=self.show, quiet=True)
-        else:
-            self.dot.render(format=self.outformat, view=self.show, quiet=True)
+        outformats = self.outformat if isinstance(self.outformat, list) else [self.outformat]
+        outformats = [one_format.lower() for one_format in outformats]
+
+        # Render all the formats with a single graphviz process. Like graphviz
+        # itself, run it next to the source file so that relative image paths
+        # resolve the same way.
+        filepath = self.dot.save()
+        dirname, filename = os.path.split(filepath)
+        cmd = [self.dot.engine, *(f"-T{one_format}" for one_format in outformats), "-O", filename]
+        try:
+            subprocess.run(
+                cmd,
+                check=True,
+                capture_output=True,
+                cwd=dirname or None,
+                startupinfo=_startupinfo(),
+            )
+        except FileNotFoundError as e:
+            raise graphviz.ExecutableNotFound(cmd) from e
+        except subprocess.CalledProcessError as e:
+            raise CalledProcessError(e.returncode, cmd, output=e.stdout, stderr=e.stderr) from e
+
+        if self.show:
+            for one_format in outformats:
+                graphviz.view(f"{filepath}.{one_format}", quiet=True)
 
 
 class Cluster(Context):
@@ -278,17 +410,19 @@ class Cluster(Context):
         """
         self.nodes = {}
         self.subgraphs = []
+        # First node contained in this cluster, resolved on exit.
+        self._first_node = None
         self.label = label
-        super().__init__("cluster_" + self.label)
 
-        # Set attributes.
-        for k, v in self._default_graph_attrs.items():
-            self.dot.graph_attr[k] = v
-        self.dot.graph_attr["label"] = self.label
+        super().__init__("cluster_" + self.label)
 
         if not self._validate_direction(direction):
             raise ValueError(f'"{direction}" is not a valid direction')
-        self.dot.graph_attr["rankdir"] = direction
+        # Kept to set up the Digraph once it is needed, see _make_dot().
+        # The attributes are copied so later changes to the passed in dict
+        # do not leak into the cluster.
+        self._rankdir = direction
+        self._graph_attr = dict(graph_attr)
 
         # Node must be belong to a diagrams.
         try:
@@ -298,11 +432,20 @@ class Cluster(Context):
 
         # Set cluster depth for distinguishing the background color
         self.depth = self._parent.depth + 1 if self._parent else 0
-        coloridx = self.depth % len(self.bgcolors)
-        self.dot.graph_attr["bgcolor"] = self.bgcolors[coloridx]
 
-        # Merge passed in attributes
-        self.dot.graph_attr.update(graph_attr)
+    def _make_dot(self) -> Digraph:
+        """Build the Digraph of this cluster, merging passed in attributes last."""
+        coloridx = self.depth % len(self.bgcolors)
+        return Digraph(
+            self.name,
+            graph_attr={
+                **self._default_graph_attrs,
+                "label": self.label,
+                "rankdir": self._rankdir,
+                "bgcolor": self.bgcolors[coloridx],
+                **self._graph_attr,
+            },
+        )
 
     def __enter__(self):
         self._before_enter()
@@ -310,16 +453,18 @@ class Cluster(Context):
         return self
 
     def __exit__(self, exc_type, exc_value, traceback):
+        # Nodes and nested subgraphs were already written to the body as they
+        # were added, so the subgraph is complete at this point.
+        self._compact_body()
         if self._parent:
             self._parent.subgraph(self.dot)
 
-        if len(self.nodes.values()) > 0:
-            for node in self.nodes.values():
-                self.dot.node(node.nodeid, label=node.label, **node._attrs)
-
-        if len(self.subgraphs) > 0:
-            for subgraph in self.subgraphs:
-                self.dot.subgraph(subgraph)
+        # Direct nodes come before the ones of nested clusters, which have
+        # already propagated their first node up by the time we exit.
+        if self.nodes:
+            self._first_node = next(iter(self.nodes.values()))
+        if isinstance(self._parent, Cluster) and self._parent._first_node is None:
+            self._parent._first_node = self._first_node
 
         setcluster(self._parent)
 
@@ -327,7 +472,7 @@ class Cluster(Context):
     def node(self, node: "Node") -> None:
         """Create a new node."""
         self.nodes[node.nodeid] = node
-        self.dot.node(node.nodeid, label=node.label, **node._attrs)
+        super().node(node)
 
     def remove_node(self, node: "Node") -> None:
         del self.nodes[node.nodeid]
@@ -341,14 +486,6 @@ class Cluster(Context):
     def _before_enter(self):
         pass
 
-    @property
-    def nodes_iter(self):
-        if self.nodes:
-            yield from self.nodes.values()
-        if self.subgraphs:
-            for subgraph in self.subgraphs:
-                yield from subgraph.nodes_iter
-
 
 class Node(Cluster):
     """Node represents a node for a specific backend service."""
@@ -378,6 +515,7 @@ class Node(Cluster):
         self._diagram = getdiagram()
         if self._diagram is None:
             raise EnvironmentError("Global diagrams context not set up")
+        self._diagram._node_count += 1
 
         if self._diagram.autolabel:
             prefix = self.__class__.__name__
@@ -398,14 +536,18 @@ class Node(Cluster):
         self._loaded_icon = self._load_icon()
 
 
-        self._attrs = {
-            "shape": "none",
-            "height": str(self._height + padding),
-            "image": self._loaded_icon,
-        } if self._loaded_icon else {}
+        if self._loaded_icon:
+            self._attrs = {
+                "shape": "none",
+                "height": str(self._height + padding),
+                "image": self._loaded_icon,
+                **attrs,
+            }
+        else:
+            # **attrs is already a fresh dict owned by this call.
+            self._attrs = attrs
 
         # fmt: on
-        self._attrs.update(attrs)
 
         # If a node is in the cluster context, add it to cluster.
         if self._parent is not None:
@@ -424,17 +566,19 @@ class Node(Cluster):
         super().__enter__()
 
         # Set attributes.
-        for k, v in self._default_graph_attrs.items():
-            self.dot.graph_attr[k] = v
+        self.dot.graph_attr.update(self._default_graph_attrs)
 
-        icon = self._load_icon()
+        icon = self._loaded_icon
         if icon:
-            lines = iter(html.escape(self.label).split("\n"))
-            self.dot.graph_attr["label"] = '<<TABLE border="0"><TR>' +\
-                f'<TD fixedsize="true" width="{self._icon_size}" height="{self._icon_size}"><IMG SRC="{icon}"></IMG></TD>' +\
-                f'<TD align="left">{next(lines)}</TD></TR>' +\
-                ''.join(f'<TR><TD colspan="2" align="left">{line}</TD></TR>' for line in lines) +\
-                '</TABLE>>'
+            first_line, *lines = html.escape(self.label).split("\n")
+            parts = [
+                '<<TABLE border="0"><TR>',
+                f'<TD fixedsize="true" width="{self._icon_size}" height="{self._icon_size}"><IMG SRC="{icon}"></IMG></TD>',
+                f'<TD align="left">{first_line}</TD></TR>',
+            ]
+            parts.extend(f'<TR><TD colspan="2" align="left">{line}</TD></TR>' for line in lines)
+            parts.append('</TABLE>>')
+            self.dot.graph_attr["label"] = "".join(parts)
 
         if not self._validate_direction(self._direction):
             raise ValueError(f'"{self._direction}" is not a valid direction')
@@ -448,9 +592,11 @@ class Node(Cluster):
         return self
 
     def __exit__(self, *args):
-        super().__exit__(*args)
+        # Rename before the subgraph is handed to the parent, so that edges
+        # using this node as lhead/ltail refer to the emitted cluster name.
         self._id = "cluster_" + self.nodeid
         self.dot.name = self.nodeid
+        super().__exit__(*args)
 
     def __repr__(self):
         _name = self.__class__.__name__
@@ -458,12 +604,8 @@ class Node(Cluster):
 
     def __sub__(self, other: Union["Node", List["Node"], "Edge"]):
         """Implement Self - Node, Self - [Nodes] and Self - Edge."""
-        if isinstance(other, list):
-            for node in other:
-                self.connect(node, Edge(self))
-            return other
-        elif isinstance(other, Node):
-            return self.connect(other, Edge(self))
+        if isinstance(other, (list, Node)):
+            return self._connect_with_edge(other)
         else:
             other.node = self
             return other
@@ -479,12 +621,8 @@ class Node(Cluster):
 
     def __rshift__(self, other: Union["Node", List["Node"], "Edge"]):
         """Implements Self >> Node, Self >> [Nodes] and Self Edge."""
-        if isinstance(other, list):
-            for node in other:
-                self.connect(node, Edge(self, forward=True))
-            return other
-        elif isinstance(other, Node):
-            return self.connect(other, Edge(self, forward=True))
+        if isinstance(other, (list, Node)):
+            return self._connect_with_edge(other, forward=True)
         else:
             other.forward = True
             other.node = self
@@ -492,12 +630,8 @@ class Node(Cluster):
 
     def __lshift__(self, other: Union["Node", List["Node"], "Edge"]):
         """Implements Self << Node, Self << [Nodes] and Self << Edge."""
-        if isinstance(other, list):
-            for node in other:
-                self.connect(node, Edge(self, reverse=True))
-            return other
-        elif isinstance(other, Node):
-            return self.connect(other, Edge(self, reverse=True))
+        if isinstance(other, (list, Node)):
+            return self._connect_with_edge(other, reverse=True)
         else:
             other.reverse = True
             return other.connect(self)
@@ -526,6 +660,20 @@ class Node(Cluster):
     def nodeid(self):
         return self._id
 
+    def _connect_with_edge(self, other: Union["Node", List["Node"]], **edge_attrs):
+        """Connect to a Node or to each of a list of Nodes with a new Edge.
+
+        :param other: Node or list of Nodes.
+        :param edge_attrs: Arguments for the new Edges.
+        :return: The other Node or list of Nodes.
+        """
+        connect = self.connect
+        if isinstance(other, list):
+            for node in other:
+                connect(node, Edge(self, **edge_attrs))
+            return other
+        return connect(other, Edge(self, **edge_attrs))
+
     # TODO: option for adding flow description to the connection edge
     def connect(self, node: "Node", edge: "Edge"):
         """Connect to other node.
@@ -544,13 +692,19 @@ class Node(Cluster):
 
     @staticmethod
     def _rand_id():
-        return uuid.uuid4().hex
+        return f"{_ID_PREFIX}{next(_id_counter):x}"
 
     def _load_icon(self):
+        key = (self._icon_dir, self._icon)
+        try:
+            return _icon_cache[key]
+        except KeyError:
+            pass
+        icon = None
         if self._icon and self._icon_dir:
-            basedir = Path(os.path.abspath(os.path.dirname(__file__)))
-            return os.path.join(basedir.parent, self._icon_dir, self._icon)
-        return None
+            icon = os.path.join(_BASE_DIR, self._icon_dir, self._icon)
+        _icon_cache[key] = icon
+        return icon
 
 
 class Edge:
@@ -589,11 +743,8 @@ class Edge:
         self.forward = forward
         self.reverse = reverse
 
-        self._attrs = {}
-
         # Set attributes.
-        for k, v in self._default_edge_attrs.items():
-            self._attrs[k] = v
+        self._attrs = self._default_edge_attrs.copy()
 
         if label:
             # Graphviz complaining about using label for edges, so replace it with xlabel.
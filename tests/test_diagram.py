@@ -1,7 +1,13 @@
+import io
 import os
 import shutil
 import unittest
 import pathlib
+import subprocess
+from unittest import mock
+
+from graphviz import ExecutableNotFound
+from graphviz.backend import CalledProcessError
 
 from diagrams import Cluster, Diagram, Edge, Node
 from diagrams.aws.compute import EC2
@@ -55,6 +61,15 @@ class DiagramTest(unittest.TestCase):
             with self.assertRaises(ValueError):
                 Diagram(outformat=fmt)
 
+    def test_fast(self):
+        self.assertNotIn("nslimit", Diagram().dot.graph_attr)
+        graph_attr = Diagram(fast=True).dot.graph_attr
+        self.assertEqual(graph_attr["nslimit"], "2")
+        self.assertEqual(graph_attr["nslimit1"], "2")
+        # Passed in attributes take precedence.
+        graph_attr = Diagram(fast=True, graph_attr={"nslimit": "5"}).dot.graph_attr
+        self.assertEqual(graph_attr["nslimit"], "5")
+
     def test_with_global_context(self):
         self.assertIsNone(getdiagram())
         with Diagram(name=os.path.join(self.name, "with_global_context"), show=False):
@@ -109,6 +124,21 @@ class DiagramTest(unittest.TestCase):
             Node("node1")
         self.assertTrue(os.path.exists(f"{self.name}.png"))
     
+    def test_auto_sfdp(self):
+        with Diagram(name=os.path.join(self.name, "small_diagram"), show=False, auto_sfdp=True) as d:
+            Node("node1")
+        self.assertEqual(d.dot.engine, "dot")
+
+        with Diagram(name=os.path.join(self.name, "large_diagram"), show=False) as d:
+            for i in range(Diagram._sfdp_node_threshold + 1):
+                Node(f"node{i}")
+        self.assertEqual(d.dot.engine, "dot")
+
+        with Diagram(name=os.path.join(self.name, "large_diagram_sfdp"), show=False, auto_sfdp=True) as d:
+            for i in range(Diagram._sfdp_node_threshold + 1):
+                Node(f"node{i}")
+        self.assertEqual(d.dot.engine, "sfdp")
+
     def test_autolabel(self):
         with Diagram(name=os.path.join(self.name, "nodes_to_node"), show=False):
             node1 = Node("node1")
@@ -127,6 +157,48 @@ class DiagramTest(unittest.TestCase):
         # clean the dot file as it only generated here
         os.remove(self.name + ".dot")
 
+    def test_render_single_process(self):
+        with mock.patch("diagrams.subprocess.run") as run:
+            with Diagram(name="Render", filename=os.path.join(self.name, "render"), show=False,
+                         outformat=["png", "svg", "dot"]):
+                Node("node1")
+        run.assert_called_once()
+        args, kwargs = run.call_args
+        self.assertEqual(args[0], ["dot", "-Tpng", "-Tsvg", "-Tdot", "-O", "render"])
+        self.assertEqual(kwargs["cwd"], self.name)
+
+    def test_render_errors(self):
+        errors = [
+            (FileNotFoundError(), ExecutableNotFound),
+            (subprocess.CalledProcessError(1, ["dot"], output=b"", stderr=b"syntax error"), CalledProcessError),
+        ]
+        for side_effect, expected in errors:
+            with mock.patch("diagrams.subprocess.run", side_effect=side_effect):
+                with self.assertRaises(expected):
+                    with Diagram(name="Render", filename=os.path.join(self.name, "render"), show=False):
+                        Node("node1")
+
+    def test_repr_png_cache(self):
+        with mock.patch("diagrams.subprocess.run"):
+            with Diagram(name=os.path.join(self.name, "repr_png_cache"), show=False) as d:
+                Node("node1")
+        with mock.patch.object(d.dot, "pipe", return_value=b"png") as pipe:
+            self.assertEqual(d._repr_png_(), b"png")
+            self.assertEqual(d._repr_png_(), b"png")
+            pipe.assert_called_once()
+
+            d.dot.attr(label="x")
+            pipe.return_value = b"png2"
+            self.assertEqual(d._repr_png_(), b"png2")
+            self.assertEqual(pipe.call_count, 2)
+
+    def test_write_source(self):
+        with Diagram(name=os.path.join(self.name, "write_source"), show=False) as d:
+            Node("node1")
+        fp = io.StringIO()
+        d.write_source(fp)
+        self.assertEqual(fp.getvalue().splitlines(), d.dot.source.splitlines())
+
 
 class ClusterTest(unittest.TestCase):
     def setUp(self):
@@ -170,6 +242,15 @@ class ClusterTest(unittest.TestCase):
                 self.assertEqual(c1, getcluster())
             self.assertEqual(d1, getcluster())
 
+    def test_graph_attr_snapshot(self):
+        with Diagram(name=os.path.join(self.name, "graph_attr_snapshot"), show=False):
+            graph_attr = {"bgcolor": "red"}
+            cluster = Cluster("A", graph_attr=graph_attr)
+            graph_attr["bgcolor"] = "blue"
+            with cluster:
+                Node("node")
+            self.assertEqual(cluster.dot.graph_attr["bgcolor"], "red")
+
     def test_node_not_in_diagram(self):
         # Node must be belong to a diagrams.
         with self.assertRaises(EnvironmentError):
@@ -210,6 +291,32 @@ class ClusterTest(unittest.TestCase):
                     c1, getcluster()
                 )
 
+    def test_node_as_cluster_removed_from_parent(self):
+        with Diagram(name=os.path.join(self.name, "node_as_cluster_removed_from_parent"), show=False) as d1:
+            node1 = Node("node1")
+            node2 = Node("node2")
+            with EC2("node-as-cluster") as c1:
+                cluster_nodeid = c1.nodeid
+                Node("node3")
+        lines = d1.dot.source.splitlines()
+        self.assertFalse(any(line.strip().startswith((cluster_nodeid, f'"{cluster_nodeid}"')) for line in lines))
+        self.assertTrue(any(node1.nodeid in line and "label=node1" in line for line in lines))
+        self.assertTrue(any(node2.nodeid in line and "label=node2" in line for line in lines))
+        self.assertNotIn("", [line.strip() for line in lines])
+
+    def test_edge_to_node_as_cluster(self):
+        with Diagram(name=os.path.join(self.name, "edge_to_node_as_cluster"), show=False, outformat="dot") as d1:
+            node1 = Node("node1")
+            c1 = EC2("node-as-cluster")
+            node1 >> c1
+            with c1:
+                node2 = Node("node2")
+        edges = [line for line in d1.dot.body if "->" in line]
+        self.assertEqual(len(edges), 1)
+        self.assertIn(node2.nodeid, edges[0])
+        self.assertIn(f"lhead={c1.nodeid}", edges[0])
+        self.assertIn(f"subgraph {c1.nodeid} {{", d1.dot.source)
+
 
 class EdgeTest(unittest.TestCase):
     def setUp(self):